@@ -1,82 +1,237 @@
+import gzip
+import hashlib
 import json
 import logging
 import os
 import sys
-import subprocess
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional, Sequence, Tuple
 
 import azure.functions as func
-import traceback
 from pathlib import Path
-import csv
+
+# subprocess, csv, traceback and platform are imported inside the (rare) code
+# paths that use them, keeping them off the cold-start import path.
+
+# Optional C-accelerated JSON encoder (falls back to stdlib json if the wheel is missing)
+try:
+    import orjson  # type: ignore
+except ImportError:
+    orjson = None
+
+# Optional brotli; gzip (stdlib) is always available
+try:
+    import brotli  # type: ignore
+except ImportError:
+    brotli = None
+
+__all__ = ["main", "prime"]
 
 # --- TEMP: hardcoded symbols for testing ---
-HARDCODED_SYMBOLS = ["AAPL", "MSFT", "NVDA", "AMZN", "GOOGL"]
+# A tuple: returned as-is (shared, immutable) when no override is given
+HARDCODED_SYMBOLS = ("AAPL", "MSFT", "NVDA", "AMZN", "GOOGL")
 
-def get_symbols(req: func.HttpRequest) -> List[str]:
+def get_symbols(req: func.HttpRequest) -> Sequence[str]:
     """
     Priority for testing:
       1) ?symbols=AAPL,MSFT (optional override)
       2) HARDCODED_SYMBOLS (default)
     """
-    qs = (req.params.get("symbols") or "").strip()
-    if qs:
-        return [s.strip().upper() for s in qs.split(",") if s.strip()]
-    return HARDCODED_SYMBOLS
+    qs = req.params.get("symbols")
+    if not qs or qs.isspace():
+        return HARDCODED_SYMBOLS
+    # One upper() over the whole value; each token is still stripped (any
+    # whitespace, incl. \r\n) with inner blanks kept, as before
+    return [t for t in map(str.strip, qs.upper().split(",")) if t]
 # -------------------------------------------
 
-# Optional import of shared pure-Python core (safe if missing)
-PREMIUMS_CORE = None
-try:
-    from ..shared import premiums_core as PREMIUMS_CORE  # type: ignore
-except Exception:
-    PREMIUMS_CORE = None
+# Optional import of shared pure-Python core (safe if missing).
+# Deferred to the first request so worker start-up doesn't pay for it.
+_PREMIUMS_CORE: Any = None
+_PREMIUMS_CORE_LOADED = False
 
-def _as_http(data: Any, status: int = 200) -> func.HttpResponse:
-    return func.HttpResponse(
-        json.dumps(data, ensure_ascii=False),
-        status_code=status,
-        mimetype="application/json",
-        headers={
+def _get_core() -> Any:
+    global _PREMIUMS_CORE, _PREMIUMS_CORE_LOADED
+    if not _PREMIUMS_CORE_LOADED:
+        try:
+            from ..shared import premiums_core as core  # type: ignore
+        except Exception:
+            core = None
+        _PREMIUMS_CORE = core
+        _PREMIUMS_CORE_LOADED = True
+    return _PREMIUMS_CORE
+
+def _dumps(data: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(data, default=str)
+    return json.dumps(data, ensure_ascii=False, default=str).encode("utf-8")
+
+def _loads(raw: bytes) -> Any:
+    return orjson.loads(raw) if orjson is not None else json.loads(raw)
+
+def _http_response(body: bytes, status: int = 200, encoding: Optional[str] = None,
+                   etag: Optional[str] = None) -> func.HttpResponse:
+    # body is already UTF-8 JSON bytes: the worker forwards it as-is, and an
+    # explicit Content-Length lets the host skip chunked transfer encoding.
+    headers = {"Content-Length": str(len(body)), "Vary": "Accept-Encoding"}
+    if etag:
+        # Cacheable, but clients must revalidate (If-None-Match -> 304)
+        headers["Cache-Control"] = "no-cache"
+        headers["ETag"] = etag
+    else:
+        headers.update({
             "Cache-Control": "no-store, no-cache, must-revalidate, proxy-revalidate",
             "Pragma": "no-cache",
             "Expires": "0"
-        }
+        })
+    if encoding:
+        headers["Content-Encoding"] = encoding
+    return func.HttpResponse(
+        body=body,
+        status_code=status,
+        mimetype="application/json",
+        headers=headers
+    )
+
+def _not_modified(etag: str) -> func.HttpResponse:
+    return func.HttpResponse(
+        status_code=304,
+        headers={"ETag": etag, "Cache-Control": "no-cache", "Vary": "Accept-Encoding"}
     )
 
+def _as_http(data: Any, status: int = 200) -> func.HttpResponse:
+    return _http_response(_dumps(data), status)
+
+# Serialized success bodies keyed by the requested symbols. An entry stays valid
+# while the core keeps returning the very same rows list (its own cache hit),
+# so repeat requests skip serialization entirely.
+_BODY_CACHE: Dict[Tuple[str, ...], Dict[str, Any]] = {}
+_BODY_CACHE_MAX = 32
+
+# The HARDCODED_SYMBOLS entry, also kept outside the dict for main()'s fast path
+_DEFAULT_ENTRY: Optional[Dict[str, Any]] = None
+
+def _cached_entry(symbols: Sequence[str], rows: List[Dict[str, Any]]) -> Dict[str, Any]:
+    global _DEFAULT_ENTRY
+    key = tuple(symbols)
+    entry = _BODY_CACHE.get(key)
+    if entry is None or entry["rows"] is not rows:
+        if key not in _BODY_CACHE and len(_BODY_CACHE) >= _BODY_CACHE_MAX:
+            _BODY_CACHE.clear()
+        body = _dumps(rows)
+        entry = {"rows": rows, "body": body,
+                 "etag": hashlib.blake2b(body, digest_size=16).hexdigest()}
+        _BODY_CACHE[key] = entry
+    if symbols is HARDCODED_SYMBOLS:
+        _DEFAULT_ENTRY = entry
+    return entry
+
+def _accepted_encoding(req: func.HttpRequest) -> Optional[str]:
+    accept = (req.headers.get("Accept-Encoding") or "").lower()
+    tokens = set()
+    for item in accept.split(","):
+        coding, *params = (part.strip() for part in item.split(";"))
+        q = 1.0
+        for param in params:
+            if param.startswith("q="):
+                try:
+                    q = float(param[2:])
+                except ValueError:
+                    q = 0.0
+        if q > 0:  # "gzip;q=0" is an explicit refusal
+            tokens.add(coding)
+    if brotli is not None and "br" in tokens:
+        return "br"
+    if "gzip" in tokens:
+        return "gzip"
+    return None
+
+def _entity_tag(entry: Dict[str, Any], encoding: Optional[str]) -> str:
+    # Each content-coding is a distinct representation, so it gets its own tag
+    suffix = "-" + encoding if encoding else ""
+    return '"%s%s"' % (entry["etag"], suffix)
+
+def _etag_matches(req: func.HttpRequest, entry: Dict[str, Any]) -> bool:
+    """True if If-None-Match names any representation of this entry's data (or *)."""
+    header = req.headers.get("If-None-Match")
+    if not header:
+        return False
+    for tag in header.split(","):
+        tag = tag.strip()
+        if tag == "*":
+            return True
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        if tag.strip('"').split("-", 1)[0] == entry["etag"]:
+            return True
+    return False
+
+def _encoded_body(entry: Dict[str, Any], encoding: Optional[str]) -> bytes:
+    """Compressed variants are built on first use and kept next to the plain body."""
+    if encoding is None:
+        return entry["body"]
+    slot = "body_" + encoding
+    body = entry.get(slot)
+    if body is None:
+        if encoding == "br":
+            body = brotli.compress(entry["body"], quality=4)
+        else:
+            body = gzip.compress(entry["body"], compresslevel=3)
+        entry[slot] = body
+    return body
+
+def _scan_dir(here: Path) -> Dict[str, "os.DirEntry[str]"]:
+    """One scandir() pass: name -> DirEntry (file type info comes cached with it)."""
+    with os.scandir(here) as it:
+        return {e.name: e for e in it}
+
+def _respond_cached(req: func.HttpRequest, entry: Dict[str, Any]) -> func.HttpResponse:
+    encoding = _accepted_encoding(req)
+    etag = _entity_tag(entry, encoding)
+    if _etag_matches(req, entry):
+        return _not_modified(etag)
+    return _http_response(_encoded_body(entry, encoding), 200, encoding, etag)
+
 def _read_csv_as_rows(csv_path: Path) -> List[Dict[str, Any]]:
-    rows: List[Dict[str, Any]] = []
+    import csv
+
     with csv_path.open(newline="", encoding="utf-8") as f:
-        reader = csv.DictReader(f)
-        for r in reader:
-            rows.append({k: (v if v is not None else "") for k, v in r.items()})
-    return rows
+        reader = csv.reader(f)
+        header = tuple(next(reader, ()))
+        width = len(header)
+        # csv.reader yields "" (never None) for empty cells; only short rows
+        # need padding so every dict carries every column.
+        return [dict(zip(header, row if len(row) >= width else row + [""] * (width - len(row))))
+                for row in reader if row]
 
-def _run_subprocess_generator(symbols: List[str]) -> List[Dict[str, Any]]:
+def _run_subprocess_generator(symbols: Sequence[str]) -> List[Dict[str, Any]]:
     """
     Run polygon_options_delta_table.py and capture data.
     Strategy:
       1) Try `--emit-json` and parse stdout as JSON.
       2) If that fails, run without the flag and read `premiums.csv` from the function dir.
     """
+    import subprocess
+
     here = Path(__file__).resolve().parent
     script = here / "polygon_options_delta_table.py"
     if not script.exists():
         raise FileNotFoundError("Cannot find script at %s" % script)
 
-    env = os.environ.copy()
-    if symbols:
-        env["SYMBOLS"] = ",".join(symbols)
+    # Same allowlisted environment as the core's runner; without the shared core
+    # there is no allowlist to apply, so the child inherits the host environment.
+    core = _get_core()
+    env = core.child_env(symbols) if core is not None else dict(os.environ, SYMBOLS=",".join(symbols))
 
     # 1) Try JSON-emitting mode
     try:
         cmd = [sys.executable, str(script), "--emit-json"]
         logging.info("Running subprocess (json mode): %s", " ".join(cmd))
+        # stdout stays bytes and is parsed directly (no text decode + strip copies)
         proc = subprocess.run(cmd, env=env, cwd=str(here), check=True,
-                              capture_output=True, text=True)
-        stdout = (proc.stdout or "").strip()
-        if stdout:
-            data = json.loads(stdout)
+                              capture_output=True)
+        stdout = proc.stdout
+        if stdout and not stdout.isspace():
+            data = _loads(stdout)
             if isinstance(data, list):
                 return data
             logging.warning("stdout was not a list; type=%s", type(data))
@@ -89,17 +244,39 @@ def _run_subprocess_generator(symbols: List[str]) -> List[Dict[str, Any]]:
     cmd2 = [sys.executable, str(script)]
     logging.info("Running subprocess (csv mode): %s", " ".join(cmd2))
     proc2 = subprocess.run(cmd2, env=env, cwd=str(here), check=True,
-                           capture_output=True, text=True)
+                           capture_output=True)
 
     # Look for a CSV the script produced in the function directory
+    entries = _scan_dir(here)
     for candidate in ("premiums.csv", "output.csv"):
-        csv_path = here / candidate
-        if csv_path.exists():
-            return _read_csv_as_rows(csv_path)
+        entry = entries.get(candidate)
+        if entry is not None and entry.is_file():
+            return _read_csv_as_rows(here / candidate)
 
     # If we get here, we couldn't obtain data
     raise RuntimeError("Script ran but produced no JSON on stdout and no premiums.csv in %s" % here)
 
+def _core_rows(core: Any, symbols: Sequence[str]) -> List[Dict[str, Any]]:
+    try:
+        rows = core.build_premiums(symbols=symbols)  # type: ignore
+    except TypeError:
+        rows = core.build_premiums()  # type: ignore
+    if not isinstance(rows, list):
+        raise TypeError("build_premiums() must return a list")
+    return rows
+
+def prime() -> int:
+    """
+    Fill the core row cache and the serialized body cache for the default
+    symbols (used by the warmup function). Returns the number of rows.
+    """
+    core = _get_core()
+    if not (core and hasattr(core, "build_premiums")):
+        return 0
+    rows = _core_rows(core, HARDCODED_SYMBOLS)
+    _cached_entry(HARDCODED_SYMBOLS, rows)
+    return len(rows)
+
 def main(req: func.HttpRequest) -> func.HttpResponse:
     # Diagnostics probe: /api/premiums?diag=runtime
     if req.params.get("diag") == "runtime":
@@ -110,7 +287,7 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
             "executable": sys.executable,
             "platform": platform.platform(),
             "func_dir": str(here),
-            "files_in_func_dir": sorted(os.listdir(str(here))),
+            "files_in_func_dir": sorted(_scan_dir(here)),
             "env": {
                 "FUNCTIONS_WORKER_RUNTIME": os.getenv("FUNCTIONS_WORKER_RUNTIME", ""),
                 "AzureWebJobsFeatureFlags": os.getenv("AzureWebJobsFeatureFlags", ""),
@@ -119,48 +296,58 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
             }
         }, 200)
 
+    # Re-probe data file locations and drop cached rows: /api/premiums?refresh=1
+    if req.params.get("refresh") == "1":
+        core = _get_core()
+        if core and hasattr(core, "invalidate_caches"):
+            core.invalidate_caches()
+
     symbols = get_symbols(req)
     logging.info("GET /api/premiums (symbols=%s)", ",".join(symbols))
 
-    # Expose to any code that reads env
-    if symbols:
-        os.environ["SYMBOLS"] = ",".join(symbols)
+    # Default symbols (identity check): answer from the precomputed entry while
+    # the core says its rows are still current -- no rebuild, no cache lock.
+    if symbols is HARDCODED_SYMBOLS and _DEFAULT_ENTRY is not None:
+        core = _get_core()
+        if core and hasattr(core, "is_fresh") and core.is_fresh(_DEFAULT_ENTRY["rows"]):
+            return _respond_cached(req, _DEFAULT_ENTRY)
 
     try:
         # If you later add a pure-Python core that returns rows directly:
-        if PREMIUMS_CORE and hasattr(PREMIUMS_CORE, "build_premiums"):
-            try:
-                rows = PREMIUMS_CORE.build_premiums(symbols=symbols)  # type: ignore
-            except TypeError:
-                rows = PREMIUMS_CORE.build_premiums()  # type: ignore
-            if not isinstance(rows, list):
-                raise TypeError("build_premiums() must return a list")
-            return _as_http(rows, 200)
+        core = _get_core()
+        if core and hasattr(core, "build_premiums"):
+            rows = _core_rows(core, symbols)
+            return _respond_cached(req, _cached_entry(symbols, rows))
 
         # Subprocess path (works today)
         rows = _run_subprocess_generator(symbols)
         return _as_http(rows, 200)
 
-    except subprocess.CalledProcessError as e:
-        logging.exception("Generator subprocess failed")
-        return _as_http({
-            "error": "generator_failed",
-            "stderr": e.stderr,
-            "returncode": e.returncode,
-            "cmd": getattr(e, "cmd", None)
-        }, 500)
-
     except Exception as e:
+        import subprocess
+
+        if isinstance(e, subprocess.CalledProcessError):
+            logging.exception("Generator subprocess failed")
+            return _as_http({
+                "error": "generator_failed",
+                "stderr": (e.stderr or b"").decode("utf-8", "replace"),
+                "returncode": e.returncode,
+                "cmd": getattr(e, "cmd", None)
+            }, 500)
+
+        import traceback
+
         logging.exception("Error generating premiums")
         here = Path(__file__).resolve().parent
-        script_path = here / "polygon_options_delta_table.py"
+        entries = _scan_dir(here)
+        script_entry = entries.get("polygon_options_delta_table.py")
         return _as_http({
             "error": "internal_error",
             "detail": str(e),
             "traceback": traceback.format_exc(),
             "cwd": os.getcwd(),
             "func_dir": str(here),
-            "script_exists": script_path.exists(),
-            "dir_listing": sorted(os.listdir(str(here))),
-            "env_SYMBOLS": os.getenv("SYMBOLS", "")
+            "script_exists": script_entry is not None and script_entry.is_file(),
+            "dir_listing": sorted(entries),
+            "symbols": symbols
         }, 500)
@@ -16,20 +16,35 @@ polygon_options_delta_table.py
       XXS = Strike, XXP = Premium, XXN = Shares * Premium
 - details.csv (long): one row per symbol×delta with strike, premium, shares*premium.
 
-Requires: requests, pandas
+Requires: requests, numpy (orjson optional)
 Env: set POLYGON_API_KEY in your environment (e.g., in ~/.zshrc)
 """
 
 import os
 import sys
+import csv
+import json
+import re
 import math
+import gzip
 import time
+import hashlib
+import functools
+import contextlib
+import threading
 import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import date, timedelta
-from typing import Dict, List, Tuple, Optional
+from typing import Dict, List, Set, Tuple, Optional
 
+import numpy as np
 import requests
-import pandas as pd
+from requests.adapters import HTTPAdapter
+
+try:
+    import orjson  # optional: faster JSON, parses/serializes bytes directly
+except ImportError:
+    orjson = None
 
 API_KEY = os.getenv("POLYGON_API_KEY", "REPLACE_WITH_YOUR_KEY")
 BASE = "https://api.polygon.io"
@@ -38,12 +53,68 @@ BASE = "https://api.polygon.io"
 SYMBOLS_FILE = "symbols.txt"
 DETAILS_FILE  = "details.csv"
 PREMIUMS_FILE = "premiums.csv"
+PREMIUMS_JSON = "premiums-ui/public/premiums.json"  # if bundling with the app’s /public folder
 
 # Deltas from 0.02 to 0.50 inclusive (step 0.02)
 TARGET_DELTAS = [i / 100 for i in range(5, 51, 5)]
+_TARGETS = np.array(TARGET_DELTAS, dtype=np.float64)
+_MIN_TARGET, _MAX_TARGET = min(TARGET_DELTAS), max(TARGET_DELTAS)
+
+# (delta, strike col, premium col, notional col) per target, formatted once
+_COL_NAMES = [(d, f"{d:.2f}S", f"{d:.2f}P", f"{d:.2f}N") for d in TARGET_DELTAS]
+PREMIUMS_FIELDS = ["symbol", "UnderlyingPrice", "Shares"] + [c for _, *cols in _COL_NAMES for c in cols]
+DETAILS_FIELDS = ["symbol", "UnderlyingPrice", "Shares", "target_delta",
+                  "strike", "premium", "shares_times_premium"]
+
+# Max Polygon requests in flight at once (worker threads sharing SESSION)
+MAX_WORKERS = int(os.getenv("POLYGON_MAX_WORKERS", "10"))
+
+# One pooled keep-alive session shared by every request (and worker thread).
+# The pool is sized so no worker has to open (and later discard) a connection;
+# get_json() does its own 429 handling, so urllib3 retries stay off.
+SESSION = requests.Session()
+_POOL_SIZE = max(32, MAX_WORKERS)
+SESSION.mount("https://", HTTPAdapter(pool_connections=_POOL_SIZE, pool_maxsize=_POOL_SIZE, max_retries=0))
+# Snapshot pages are large; ask for them compressed explicitly. urllib3 inflates
+# once into r.content, which get_json() hands to loads_bytes() as-is.
+SESSION.headers["Accept-Encoding"] = "gzip, deflate"
 
 
 # --------------------------- Helpers -----------------------------------
+def dumps_bytes(obj) -> bytes:
+    """JSON-encode to UTF-8 bytes so callers can write it with a single write()."""
+    if orjson is not None:
+        return orjson.dumps(obj, default=str)
+    return json.dumps(obj, ensure_ascii=False, default=str).encode("utf-8")
+
+
+def loads_bytes(data: bytes):
+    """Parse JSON from raw bytes (orjson when available; both raise ValueError subclasses)."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+@contextlib.contextmanager
+def atomic_open(path: str, mode: str = "wb", **kwargs):
+    """
+    open() for writing via a sibling temp file that os.replace()s path only
+    after the block completes, so readers (e.g. the UI polling premiums.json)
+    see the old file or the new one, never a partial write.
+    """
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp, mode, **kwargs) as f:
+            yield f
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+
+
 def require_key():
     if not API_KEY or API_KEY in {"REPLACE_WITH_YOUR_KEY", "YOUR_KEY"}:
         print("ERROR: Please set POLYGON_API_KEY in your environment to your REAL key.", file=sys.stderr)
@@ -71,66 +142,218 @@ def fnum(x):
         return math.nan
 
 
-def load_symbols_with_shares(path: str) -> List[Tuple[str, int]]:
+# symbol, then optional shares after a comma and/or whitespace ("I:SPX,50", "AAPL 200", "MSFT")
+_SYMBOL_LINE = re.compile(r"\s*([^\s,#]+)(?:[\s,]+([+-]?\d+)(?![^\s,#]))?")
+
+
+def parse_symbols_file(path: str) -> List[Tuple[str, int]]:
     """Return list of (symbol, shares_int). Accepts 'SYM,shares' or 'SYM shares' or 'SYM'."""
-    if not os.path.exists(path):
-        print(f"ERROR: symbols file not found: {path}", file=sys.stderr)
-        sys.exit(2)
     out: List[Tuple[str, int]] = []
+    match = _SYMBOL_LINE.match
     with open(path, "r", encoding="utf-8") as f:
         for line in f:
-            raw = line.strip()
-            if not raw or raw.startswith("#"):
+            m = match(line)
+            if m is None:  # blank line or '#' comment
                 continue
-            shares = 0
-            sym = raw
-            if "," in raw:
-                parts = [p.strip() for p in raw.split(",", 1)]
-                sym = parts[0]
-                if len(parts) > 1 and parts[1]:
-                    try: shares = int(parts[1])
-                    except: shares = 0
-            else:
-                parts = raw.split()
-                if len(parts) >= 2:
-                    sym = parts[0]
-                    try: shares = int(parts[1])
-                    except: shares = 0
-            out.append((sym, shares))
+            sym, shares = m.groups()
+            out.append((sym, int(shares) if shares else 0))
+    return out
+
+
+def load_symbols_with_shares(path: str) -> List[Tuple[str, int]]:
+    """CLI wrapper around parse_symbols_file(): exits if the file is missing or empty."""
+    if not os.path.exists(path):
+        print(f"ERROR: symbols file not found: {path}", file=sys.stderr)
+        sys.exit(2)
+    out = parse_symbols_file(path)
     if not out:
         print(f"ERROR: no symbols found in {path}", file=sys.stderr)
         sys.exit(2)
     return out
 
 
-# -------------------- HTTP with Retry/Backoff --------------------------
+# -------------------- HTTP with Rate Limiting ---------------------------
+class TokenBucket:
+    """
+    Thread-safe token bucket with AIMD pacing: every 429 cuts the refill rate
+    (x0.7) and pauses all callers; each run of SUCCESS_WINDOW successes adds
+    0.5 req/s back, up to max_rate. A rate <= 0 disables pacing (429 pauses
+    still apply).
+    """
+    SUCCESS_WINDOW = 20
+
+    def __init__(self, rate: float, burst: float, min_rate: float = 0.2, max_rate: Optional[float] = None):
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.max_rate = max_rate if max_rate is not None else rate * 4
+        self.tokens = burst
+        self.stamp = time.monotonic()
+        self.paused_until = 0.0
+        self.successes = 0
+        self.lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        if self.rate <= 0:
+            return
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def acquire(self) -> None:
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                elif self.rate <= 0:
+                    return
+                elif self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                else:
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def on_success(self) -> None:
+        if self.rate <= 0:
+            return
+        with self.lock:
+            self.successes += 1
+            if self.successes >= self.SUCCESS_WINDOW:
+                self.successes = 0
+                self.rate = min(self.max_rate, self.rate + 0.5)
+
+    def on_throttle(self, retry_after: Optional[float] = None, floor: float = 0.0) -> float:
+        """
+        Record a 429; returns the pause applied to all callers before the next
+        request: the largest of Retry-After, the caller's backoff floor and one
+        token interval at the reduced rate.
+        """
+        with self.lock:
+            now = time.monotonic()
+            pause = max(retry_after or 0.0, floor)
+            if self.rate > 0:
+                self._refill(now)
+                self.successes = 0
+                self.rate = max(self.min_rate, self.rate * 0.7)
+                self.tokens = 0.0
+                pause = max(pause, 1.0 / self.rate)
+            self.paused_until = max(self.paused_until, now + pause)
+            return pause
+
+
+# Shared by every worker thread; POLYGON_RATE_LIMIT is the starting req/s (<= 0: unpaced)
+_RATE = float(os.getenv("POLYGON_RATE_LIMIT", "5"))
+BUCKET = TokenBucket(rate=_RATE, burst=max(1.0, _RATE))
+
+
 def get_json(url: str, params: Optional[dict] = None, timeout: int = 60, max_retries: int = 5):
     url = add_api_key_to_url(url)
-    backoff = 1.0
+    backoff = 1.0  # per-attempt floor under the bucket's pause: 1, 2, 4, 8, 8s
     for attempt in range(1, max_retries + 1):
-        r = requests.get(url, params=params, timeout=timeout)
+        BUCKET.acquire()
+        r = SESSION.get(url, params=params, timeout=timeout)
         if 200 <= r.status_code < 300:
-            return r.json()
+            BUCKET.on_success()
+            return loads_bytes(r.content)
         if r.status_code == 429:
             ra = r.headers.get("Retry-After")
             try:
-                delay = float(ra) if ra and ra.isdigit() else backoff
-            except Exception:
-                delay = backoff
-            print(f"[WARN] 429 Too Many Requests for {url}. Sleeping {delay:.2f}s (attempt {attempt}/{max_retries})")
-            time.sleep(delay)
+                retry_after = float(ra) if ra else None
+            except ValueError:
+                retry_after = None
+            delay = BUCKET.on_throttle(retry_after, floor=backoff)
             backoff = min(backoff * 2, 8.0)
+            print(f"[WARN] 429 Too Many Requests for {url}. Pausing {delay:.2f}s, rate now {BUCKET.rate:.2f}/s (attempt {attempt}/{max_retries})")
             continue
         print(f"[ERROR] HTTP {r.status_code} for {url}: {r.text}")
         r.raise_for_status()
     raise RuntimeError(f"Failed after {max_retries} retries: {url}")
 
 
+# ---------------------------- Disk Cache --------------------------------
+CACHE_DIR = os.getenv("POLYGON_CACHE_DIR", ".cache")
+CACHE_TTL = float(os.getenv("POLYGON_CACHE_TTL", "300"))  # seconds; 0 disables
+# Grouped closes only change once a session settles, so they may live longer
+GROUPED_CACHE_TTL = float(os.getenv("POLYGON_GROUPED_CACHE_TTL", "3600"))
+
+
+def _cache_path(key: str) -> str:
+    digest = hashlib.sha1(f"{key}|{date.today().isoformat()}".encode("utf-8")).hexdigest()
+    return os.path.join(CACHE_DIR, f"{digest}.json.gz")
+
+
+def cache_read(key: str, ttl: Optional[float] = None):
+    """Return the cached object for key if younger than ttl (default CACHE_TTL), else None."""
+    if CACHE_TTL <= 0:
+        return None
+    path = _cache_path(key)
+    try:
+        if time.time() - os.path.getmtime(path) > (CACHE_TTL if ttl is None else ttl):
+            return None
+        with open(path, "rb") as f:
+            return loads_bytes(gzip.decompress(f.read()))
+    except (OSError, ValueError):
+        return None
+
+
+_CACHE_PRUNED = False
+
+
+def _prune_cache() -> None:
+    """Delete cache files (and stray .tmp files) older than the longest TTL."""
+    cutoff = time.time() - max(CACHE_TTL, GROUPED_CACHE_TTL)
+    with os.scandir(CACHE_DIR) as it:
+        for entry in it:
+            try:
+                if entry.is_file() and entry.stat().st_mtime < cutoff:
+                    os.unlink(entry.path)
+            except OSError:
+                pass
+
+
+def cache_write(key: str, obj) -> None:
+    """Atomically store obj under key; a read-only or full disk just skips caching."""
+    global _CACHE_PRUNED
+    if CACHE_TTL <= 0:
+        return
+    path = _cache_path(key)
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        if not _CACHE_PRUNED:
+            # Keys are per day, so expired files are never overwritten; sweep
+            # them once per process so the directory can't grow without bound
+            _CACHE_PRUNED = True
+            _prune_cache()
+        with atomic_open(path, "wb") as f:
+            f.write(gzip.compress(dumps_bytes(obj), compresslevel=1))
+    except OSError as e:
+        print(f"[WARN] Could not write cache {path}: {e}")
+
+
+def disk_cached(prefix: str):
+    """Memoize a function's JSON-able result on disk, keyed by prefix + args."""
+    def deco(fn):
+        @functools.wraps(fn)
+        def wrapper(*args):
+            key = "|".join([prefix, *map(str, args)])
+            hit = cache_read(key)
+            if hit is not None:
+                return hit
+            out = fn(*args)
+            cache_write(key, out)
+            return out
+        return wrapper
+    return deco
+
+
 # ----------------------- Prices (Bulk + Fallback) -----------------------
-def find_latest_grouped_stock_closes(max_lookback: int = 7):
+def find_latest_grouped_stock_closes(max_lookback: int = 7, wanted: Optional[Set[str]] = None):
     """
     Try /v2/aggs/grouped/locale/us/market/stocks/{YYYY-MM-DD} going backward
-    up to max_lookback days. Returns (date_str, {ticker: close}).
+    up to max_lookback days. Returns (date_str, {ticker: close}), limited to
+    the tickers in wanted when given.
     """
     for i in range(max_lookback):
         ds = (date.today() - timedelta(days=i)).isoformat()
@@ -139,12 +362,10 @@ def find_latest_grouped_stock_closes(max_lookback: int = 7):
             js = get_json(url, params=None, timeout=120)
             rows = js.get("results") or []
             if rows:
-                out = {}
-                for r in rows:
-                    t = r.get("T")
-                    c = r.get("c")
-                    if t and c is not None:
-                        out[str(t)] = float(c)
+                if wanted is None:
+                    out = {t: float(c) for r in rows if (t := r.get("T")) and (c := r.get("c")) is not None}
+                else:
+                    out = {t: float(c) for r in rows if (t := r.get("T")) in wanted and (c := r.get("c")) is not None}
                 print(f"[INFO] Using grouped stock closes for {ds} ({len(out)} tickers)")
                 return ds, out
         except Exception as e:
@@ -154,6 +375,18 @@ def find_latest_grouped_stock_closes(max_lookback: int = 7):
     return None, {}
 
 
+def grouped_stock_closes(stockish: List[str]) -> Dict[str, float]:
+    """find_latest_grouped_stock_closes() for these tickers, memoized on disk for the day."""
+    key = "grouped|" + ",".join(sorted(set(stockish)))
+    hit = cache_read(key, ttl=GROUPED_CACHE_TTL)
+    if hit is not None:
+        return hit
+    ds, out = find_latest_grouped_stock_closes(wanted=set(stockish))
+    if ds is not None:
+        cache_write(key, out)
+    return out
+
+
 def get_underlying_prices(symbols: List[str]) -> Dict[str, float]:
     """
     Map {symbol: prev_close}. Use grouped stocks first, then per-symbol fallback.
@@ -163,39 +396,69 @@ def get_underlying_prices(symbols: List[str]) -> Dict[str, float]:
     stockish = [s for s in symbols if not s.startswith("I:")]
     indexish = [s for s in symbols if s.startswith("I:")]
 
-    _, grouped_map = find_latest_grouped_stock_closes()
+    # Indices are never in the grouped stocks endpoint; skip its lookback entirely
+    grouped_map = grouped_stock_closes(stockish) if stockish else {}
     for s in stockish:
         if s in grouped_map:
             prices[s] = grouped_map[s]
 
     need_single = [s for s in symbols if s.startswith("I:") or s not in prices]
-    for s in need_single:
-        try:
-            url = f"{BASE}/v2/aggs/ticker/{s}/prev"
-            js = get_json(url, timeout=30)  # retry/backoff on 429
-            res = js.get("results") or []
-            if res and res[0].get("c") is not None:
-                prices[s] = float(res[0]["c"])
-            else:
-                print(f"[WARN] No prev close in response for {s}")
-        except Exception as e:
-            print(f"[WARN] Prev close fetch failed for {s}: {e}")
+    if need_single:
+        with ThreadPoolExecutor(max_workers=min(8, len(need_single))) as ex:
+            futs = {ex.submit(_fetch_prev, s): s for s in need_single}
+            for f in as_completed(futs):
+                px = f.result()
+                if px is not None:
+                    prices[futs[f]] = px
     return prices
 
 
+def _fetch_prev(s: str) -> Optional[float]:
+    """Previous close for one ticker via /v2/aggs/ticker/{sym}/prev; None on failure."""
+    try:
+        url = f"{BASE}/v2/aggs/ticker/{s}/prev"
+        js = get_json(url, timeout=30)  # paced by BUCKET
+        res = js.get("results") or []
+        if res and res[0].get("c") is not None:
+            return float(res[0]["c"])
+        print(f"[WARN] No prev close in response for {s}")
+    except Exception as e:
+        print(f"[WARN] Prev close fetch failed for {s}: {e}")
+    return None
+
+
 # ----------------------- Snapshots (Options) ----------------------------
+@disk_cached("chain")
 def fetch_chain_snapshot(symbol: str, expiration: str, opt_type: str) -> List[dict]:
-    """Fetch all snapshot pages for one underlying and (fixed) expiration."""
+    """
+    Fetch snapshot pages for one underlying and (fixed) expiration, in strike
+    order. Paging stops early once the chain has covered the whole target
+    range: |delta| is monotonic in strike, so later contracts only move
+    further from every target.
+    """
     print(f"[INFO] Fetching snapshot for {symbol}, expiration={expiration}, type={opt_type}")
     base_url = f"{BASE}/v3/snapshot/options/{symbol}"
-    params = {"limit": 250, "expiration_date": expiration, "contract_type": opt_type, "apiKey": API_KEY}
+    params = {"limit": 250, "expiration_date": expiration, "contract_type": opt_type,
+              "sort": "strike_price", "order": "asc", "apiKey": API_KEY}
     results, url = [], base_url
+    lo_seen, hi_seen = math.inf, -math.inf
+    # Pages stay serial: each cursor (next_url) is only known once the previous
+    # page arrives, and chains of different symbols already download in
+    # parallel (collect_rows), so a speculative prefetch would only add requests
+    # against the rate limit.
     while url:
         js = get_json(url, params=params if url == base_url else None, timeout=60)
         page = js.get("results") or []
         print(f"[DEBUG] Retrieved {len(page)} snapshot rows for {symbol}")
         results.extend(page)
         url, params = js.get("next_url"), None
+        for d in map(get_delta, page):
+            if d is not None and math.isfinite(d):
+                d = abs(d)
+                lo_seen, hi_seen = min(lo_seen, d), max(hi_seen, d)
+        if url and lo_seen <= _MIN_TARGET and hi_seen >= _MAX_TARGET:
+            print(f"[DEBUG] {symbol}: target deltas covered, skipping remaining pages")
+            break
     print(f"[INFO] Total snapshot rows for {symbol} @ {expiration}: {len(results)}")
     return results
 
@@ -232,44 +495,106 @@ def mid_price_from_snapshot(snap: dict) -> float:
 
 
 # --------------------------- Core logic ---------------------------------
-def pick_by_delta(snaps: List[dict], target_delta: float) -> Optional[dict]:
-    """Pick the contract whose |delta| is closest to target_delta."""
-    best, best_dist = None, float("inf")
-    for s in snaps:
-        d = get_delta(s)
-        if d is None:
-            continue
-        dist = abs(abs(d) - target_delta)
-        if dist < best_dist:
-            best, best_dist = s, dist
-    return best
+def abs_deltas(snaps: List[dict]) -> np.ndarray:
+    """|delta| for every snapshot, computed once; NaN where delta is missing or not finite."""
+    out = np.fromiter((np.nan if d is None else d for d in map(get_delta, snaps)),
+                      dtype=np.float64, count=len(snaps))
+    out = np.abs(out)
+    out[~np.isfinite(out)] = np.nan
+    return out
+
+
+def pick_by_deltas(snaps: List[dict], targets: np.ndarray) -> List[Optional[dict]]:
+    """
+    For each target, the contract whose |delta| is closest (first one on ties),
+    via one broadcast |abs_d - target| matrix; None for all if no deltas.
+    """
+    abs_d = abs_deltas(snaps)
+    if not len(abs_d) or np.isnan(abs_d).all():
+        return [None] * len(targets)
+    best = np.nanargmin(np.abs(abs_d[:, None] - targets[None, :]), axis=0)
+    return [snaps[i] for i in best.tolist()]
 
 
 def build_row_for_symbol(symbol: str, shares: int, opt_type: str, expiration: str, underlying_price: float) -> dict:
     """Wide row: symbol, UnderlyingPrice, Shares, then for each delta => {S,P,N}."""
     snaps = fetch_chain_snapshot(symbol, expiration, opt_type)
+    return build_row(symbol, shares, snaps, underlying_price)
+
+
+def build_row(symbol: str, shares: int, snaps: List[dict], underlying_price: float) -> dict:
+    """Same as build_row_for_symbol() for an already-fetched chain."""
     row = {"symbol": symbol, "UnderlyingPrice": underlying_price, "Shares": shares}
-    for d in TARGET_DELTAS:
-        chosen = pick_by_delta(snaps, d)
-        colS, colP, colN = f"{d:.2f}S", f"{d:.2f}P", f"{d:.2f}N"
+    # Neighbouring targets often land on the same contract (sparse strikes, short
+    # chains); read each chosen snapshot's strike/premium once.
+    cells: Dict[int, Tuple] = {}
+    for (_, colS, colP, colN), chosen in zip(_COL_NAMES, pick_by_deltas(snaps, _TARGETS)):
         if chosen is None:
-            row[colS] = ""
-            row[colP] = ""
-            row[colN] = ""
+            row[colS] = row[colP] = row[colN] = ""
             continue
-        strike = get_details_field(chosen, "strike_price")
-        prem = mid_price_from_snapshot(chosen)
-        row[colS] = strike if strike is not None else ""
-        row[colP] = prem if not (isinstance(prem, float) and math.isnan(prem)) else ""
-        row[colN] = "" if (row[colP] == "" or shares is None) else shares * prem
+        cell = cells.get(id(chosen))
+        if cell is None:
+            strike = get_details_field(chosen, "strike_price")
+            prem = mid_price_from_snapshot(chosen)
+            S = strike if strike is not None else ""
+            P = prem if not (isinstance(prem, float) and math.isnan(prem)) else ""
+            N = "" if (P == "" or shares is None) else shares * prem
+            cell = cells[id(chosen)] = (S, P, N)
+        row[colS], row[colP], row[colN] = cell
     return row
 
 
 # ------------------------------ Main ------------------------------------
-def main():
+def collect_rows(pairs: List[Tuple[str, int]], opt_type: str, expiration: str) -> List[dict]:
+    """Build one wide row per (symbol, shares); symbols that fail are logged and skipped."""
+    symbols_only = [s for s, _ in pairs]
+
+    # Underlying prices and option chains don't depend on each other, so all of
+    # them are requested up front; rows are assembled (in symbols.txt order) as
+    # the chains arrive.
+    with ThreadPoolExecutor(max_workers=max(1, min(MAX_WORKERS, len(pairs) + 1))) as ex:
+        prices_future = ex.submit(get_underlying_prices, symbols_only)
+        chain_futures = [ex.submit(fetch_chain_snapshot, sym, expiration, opt_type) for sym, _ in pairs]
+        price_map = prices_future.result()
+
+        rows = []
+        for (sym, shares), fut in zip(pairs, chain_futures):
+            upx = price_map.get(sym)  # None (not NaN) so CSV/JSON output stays blank/null
+            print(f"[INFO] Processing {sym} (shares={shares})  UnderlyingPrice={upx}")
+            try:
+                rows.append(build_row(sym, shares, fut.result(), upx))
+            except requests.HTTPError as e:
+                print(f"[ERROR] {sym}: {e}")
+            except Exception as e:
+                print(f"[ERROR] {sym}: {e}")
+    return rows
+
+
+def generate(symbols: Optional[List[str]] = None, opt_type: str = "call") -> List[dict]:
+    """
+    In-process entry point (used by the Functions app instead of a subprocess).
+    Returns the wide rows without writing any files. Shares come from
+    symbols.txt when it lists the symbol, else 0. With no symbols, the whole
+    symbols.txt is used. Raises instead of exiting so the host stays up.
+    """
+    if not API_KEY or API_KEY in {"REPLACE_WITH_YOUR_KEY", "YOUR_KEY"}:
+        raise RuntimeError("POLYGON_API_KEY is not set")
+    file_pairs = parse_symbols_file(SYMBOLS_FILE) if os.path.exists(SYMBOLS_FILE) else []
+    if symbols:
+        shares_by_symbol = dict(file_pairs)
+        pairs = [(s, shares_by_symbol.get(s, 0)) for s in symbols]
+    else:
+        pairs = file_pairs
+    if not pairs:
+        return []
+    return collect_rows(pairs, opt_type, next_friday_str())
+
+
+def main(argv: Optional[List[str]] = None) -> List[dict]:
+    """CLI run: fetch, write premiums.csv/premiums.json/details.csv, and return the wide rows."""
     parser = argparse.ArgumentParser(description="Premiums table for next Friday with S/P/N columns per delta.")
     parser.add_argument("--type", choices=["call", "put"], required=True, help="Option type to fetch.")
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
     require_key()
     pairs = load_symbols_with_shares(SYMBOLS_FILE)
@@ -277,58 +602,43 @@ def main():
     print(f"[INFO] Using expiration: {expiration}")
     print(f"[INFO] Loaded {len(pairs)} symbols from {SYMBOLS_FILE}")
 
-    symbols_only = [s for s, _ in pairs]
-    price_map = get_underlying_prices(symbols_only)
-
-    rows = []
-    for sym, shares in pairs:
-        upx = price_map.get(sym, math.nan)
-        print(f"[INFO] Processing {sym} (shares={shares})  UnderlyingPrice={upx}")
-        try:
-            rows.append(build_row_for_symbol(sym, shares, args.type, expiration, upx))
-        except requests.HTTPError as e:
-            print(f"[ERROR] {sym}: {e}")
-        except Exception as e:
-            print(f"[ERROR] {sym}: {e}")
+    rows = collect_rows(pairs, args.type, expiration)
 
     if not rows:
         print("[ERROR] No data collected.")
         sys.exit(2)
 
-    # Write premiums.csv (wide)
-    df = pd.DataFrame(rows)
-    fixed = ["symbol", "UnderlyingPrice", "Shares"]
-    delta_cols = []
-    for d in TARGET_DELTAS:
-        delta_cols.extend([f"{d:.2f}S", f"{d:.2f}P", f"{d:.2f}N"])
-    cols = [c for c in (fixed + delta_cols) if c in df.columns]
-    df = df.reindex(columns=cols)
-    df.to_csv(PREMIUMS_FILE, index=False)
+    # Write premiums.csv (wide); rows already carry every column in order
+    with atomic_open(PREMIUMS_FILE, "w", newline="", encoding="utf-8") as f:
+        w = csv.DictWriter(f, fieldnames=PREMIUMS_FIELDS, lineterminator="\n")
+        w.writeheader()
+        w.writerows(rows)
     print(f"[INFO] Wrote pivot to {PREMIUMS_FILE}")
 
-    # after writing premiums.csv
-    PREMIUMS_JSON = "premiums-ui/public/premiums.json"  # if bundling with the app’s /public folder
-    df.to_json(PREMIUMS_JSON, orient="records")
+    # after writing premiums.csv; rows are already in column order, so no reshaping
+    with atomic_open(PREMIUMS_JSON, "wb") as f:
+        f.write(dumps_bytes(rows))
     print(f"[INFO] Wrote JSON to {PREMIUMS_JSON}")
 
-    # Write details.csv (long)
-    detail_rows = []
-    for r in rows:
-        sym = r["symbol"]; px = r["UnderlyingPrice"]; sh = r["Shares"]
-        for d in TARGET_DELTAS:
-            S, P, N = r.get(f"{d:.2f}S"), r.get(f"{d:.2f}P"), r.get(f"{d:.2f}N")
-            detail_rows.append({
-                "symbol": sym, "UnderlyingPrice": px, "Shares": sh,
-                "target_delta": float(f"{d:.2f}"),
-                "strike": S, "premium": P, "shares_times_premium": N
-            })
-    pd.DataFrame(detail_rows).to_csv(DETAILS_FILE, index=False)
+    # Write details.csv (long), streamed straight from the wide rows
+    with atomic_open(DETAILS_FILE, "w", newline="", encoding="utf-8") as f:
+        w = csv.DictWriter(f, fieldnames=DETAILS_FIELDS, lineterminator="\n")
+        w.writeheader()
+        for r in rows:
+            sym = r["symbol"]; px = r["UnderlyingPrice"]; sh = r["Shares"]
+            for d, colS, colP, colN in _COL_NAMES:
+                w.writerow({
+                    "symbol": sym, "UnderlyingPrice": px, "Shares": sh,
+                    "target_delta": round(d, 2),
+                    "strike": r.get(colS), "premium": r.get(colP), "shares_times_premium": r.get(colN)
+                })
     print(f"[INFO] Wrote details to {DETAILS_FILE}")
+    return rows
 
 
 # === REPLACE your current bottom guard with this ENTIRE block ===
 if __name__ == "__main__":
-    import argparse, json, sys, csv, io, contextlib
+    import io
     from pathlib import Path
 
     def _num(v):
@@ -345,6 +655,7 @@ if __name__ == "__main__":
 
     parser = argparse.ArgumentParser(add_help=False)
     parser.add_argument("--emit-json", action="store_true")
+    parser.add_argument("--type", choices=["call", "put"], default="call")
     # Adjust these if your script writes elsewhere:
     parser.add_argument("--json-out", default=str(Path("premiums-ui") / "public" / "premiums.json"))
     parser.add_argument("--csv-out", default="premiums.csv")
@@ -352,18 +663,16 @@ if __name__ == "__main__":
     args, _ = parser.parse_known_args()
 
     if not args.emit_json:
-        # Normal behavior (unchanged)
-        sys.exit(main())
+        # Normal behavior (main() exits non-zero itself on failure)
+        main()
+        sys.exit(0)
 
     # --emit-json path: run main() first but silence its stdout so we can emit clean JSON
+    rows = None
     stdout_sink = io.StringIO()
     with contextlib.redirect_stdout(stdout_sink):
-        # If main() returns a code, respect it but keep going to try emitting JSON
         try:
-            rc = main()
-            if isinstance(rc, int) and rc not in (0, None):
-                # continue anyway — we’ll try to emit whatever artifacts exist
-                pass
+            rows = main(["--type", args.type])
         except SystemExit:
             # Allow main() to sys.exit(); keep going to emit JSON
             pass
@@ -371,17 +680,22 @@ if __name__ == "__main__":
             # Swallow here; we’ll fall back to CSV/empty JSON
             pass
 
+    # 0) Serialize the rows main() just built; no need to re-read its files
+    if rows:
+        sys.stdout.buffer.write(dumps_bytes(rows))
+        sys.exit(0)
+
+    # Otherwise fall back to artifacts left by a prior run
     json_path = Path(args.json_out)
     csv_path = Path(args.csv_out)
 
     # 1) Prefer the JSON your script already wrote
     if json_path.is_file():
-        sys.stdout.write(json_path.read_text(encoding="utf-8"))
+        sys.stdout.buffer.write(json_path.read_bytes())
         sys.exit(0)
 
     # 2) Else convert CSV (wide format) to JSON list[dict] expected by the UI
     if csv_path.is_file():
-        deltas = [f"{i*0.05:.2f}" for i in range(1, 11)]  # 0.05..0.50
         rows = []
         with csv_path.open("r", encoding="utf-8") as f:
             reader = csv.DictReader(f)
@@ -391,13 +705,11 @@ if __name__ == "__main__":
                     "UnderlyingPrice": _num(row.get("UnderlyingPrice") or row.get("Underlying") or row.get("Price")),
                     "Shares": _num(row.get("Shares") or row.get("Qty") or row.get("Quantity")),
                 }
-                for dk in deltas:
-                    for suf in ("S", "P", "N"):
-                        key = f"{dk}{suf}"
-                        if key in row:
-                            rec[key] = _num(row.get(key))
+                for key in PREMIUMS_FIELDS[3:]:
+                    if key in row:
+                        rec[key] = _num(row.get(key))
                 rows.append(rec)
-        sys.stdout.write(json.dumps(rows, ensure_ascii=False))
+        sys.stdout.buffer.write(dumps_bytes(rows))
         sys.exit(0)
 
     # 3) Nothing to emit
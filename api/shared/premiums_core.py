@@ -2,13 +2,27 @@ from __future__ import annotations
 
 import json
 import os
+import re
 import sys
-import csv
-from typing import List, Dict, Any, Optional
+import time
+import operator
+import functools
+import importlib.util
+import threading
+from typing import List, Dict, Any, NamedTuple, Optional, Sequence, Tuple
 from pathlib import Path
-import subprocess
 import logging
 
+try:
+    import orjson  # type: ignore
+except ImportError:
+    orjson = None
+
+
+def _loads(raw: bytes) -> Any:
+    """Parse JSON straight from bytes (orjson when installed)."""
+    return orjson.loads(raw) if orjson is not None else json.loads(raw)
+
 # ---- Configuration ---------------------------------------------------------
 
 # Where your legacy generator lives relative to the repo root / Functions app.
@@ -35,6 +49,25 @@ CSV_PATHS = [
 # Deltas the UI expects (5% steps)
 TARGET_DELTAS = [round(i * 0.05, 2) for i in range(1, 11)]  # 0.05..0.50
 
+# ("0.05S", "0.05P", "0.05N"), ... precomputed so row parsing does no formatting
+_DELTA_KEYS: List[Tuple[str, str, str]] = [
+    (f"{d:.2f}S", f"{d:.2f}P", f"{d:.2f}N") for d in TARGET_DELTAS
+]
+
+# Numeric columns of the wide premiums.csv, in output order
+_NUMERIC_COLUMNS = ["UnderlyingPrice", "Shares"] + [k for keys in _DELTA_KEYS for k in keys]
+
+# How long (seconds) a warm worker may reuse the last parsed rows before
+# re-reading the source. The source file's mtime is checked on every hit too.
+_CACHE_TTL = float(os.getenv("PREMIUMS_CACHE_TTL", "30"))
+_CACHE: Dict[str, Any] = {"rows": None, "mtime": None, "ts": 0.0, "path": None, "symbols": None}
+_CACHE_LOCK = threading.Lock()
+
+# Set to 1 on hosts that can't import the generator (e.g. missing deps) to
+# fall back to running it as `python polygon_options_delta_table.py`.
+_GENERATOR_SUBPROCESS = os.getenv("PREMIUMS_GENERATOR_SUBPROCESS", "") == "1"
+_GENERATOR_MODULE: Any = None
+
 
 # ---- Helpers ---------------------------------------------------------------
 
@@ -47,10 +80,25 @@ def _log_where(paths: List[Path]) -> Optional[Path]:
     return None
 
 
+class _ResolvedPaths(NamedTuple):
+    generator: Optional[Path]
+    json: Optional[Path]
+    csv: Optional[Path]
+
+
+@functools.lru_cache(maxsize=None)
+def _resolve_paths() -> _ResolvedPaths:
+    """Probe the candidate locations once per worker; see invalidate_caches()."""
+    return _ResolvedPaths(
+        generator=_log_where(DEFAULT_GENERATOR_PATHS),
+        json=_log_where(PUBLIC_JSON_PATHS),
+        csv=_log_where(CSV_PATHS),
+    )
+
+
 def _load_json_file(p: Path) -> Optional[List[Dict[str, Any]]]:
     try:
-        with p.open("r", encoding="utf-8") as f:
-            data = json.load(f)
+        data = _loads(p.read_bytes())
         if isinstance(data, list):
             return data
         logging.warning("JSON at %s was not a list; type=%s", p, type(data))
@@ -59,74 +107,159 @@ def _load_json_file(p: Path) -> Optional[List[Dict[str, Any]]]:
     return None
 
 
+# Below this size the stdlib reader wins: Arrow/pandas setup costs more than parsing
+_ARROW_MIN_BYTES = 64 * 1024
+
+
 def _csv_to_rows(p: Path) -> Optional[List[Dict[str, Any]]]:
     """
     Parse a 'wide' premiums.csv into the list[dict] shape the UI expects.
     Expected columns include: symbol, UnderlyingPrice, Shares, and for each delta:
       "<delta>S", "<delta>P", "<delta>N"
     We'll accept both 0.05 or 0.05 formatted strings (two decimals).
+    Large files go through pyarrow's vectorized reader when it is installed;
+    small ones (or no pyarrow) use the csv module.
     """
+    pacsv = None
     try:
-        with p.open("r", encoding="utf-8") as f:
-            reader = csv.DictReader(f)
-            out: List[Dict[str, Any]] = []
-            for row in reader:
-                rec: Dict[str, Any] = {
-                    "symbol": row.get("symbol"),
-                    "UnderlyingPrice": _num(row.get("UnderlyingPrice")),
-                    "Shares": _num(row.get("Shares")),
-                }
-                # Map any of 0.05S/0.05P/0.05N etc.
-                for d in TARGET_DELTAS:
-                    dkey = f"{d:.2f}"
-                    for suf in ("S", "P", "N"):
-                        key = f"{dkey}{suf}"
-                        val = row.get(key)
-                        rec[key] = _num(val)
-                out.append(rec)
-        return out
+        if p.stat().st_size >= _ARROW_MIN_BYTES:
+            try:
+                import pyarrow.csv as pacsv  # type: ignore
+            except ImportError:
+                pacsv = None
+        if pacsv is not None:
+            import pyarrow as pa  # type: ignore
+
+            try:
+                return _csv_to_rows_arrow(p, pacsv)
+            except pa.ArrowInvalid as e:
+                # e.g. a short/over-long row: Arrow is strict about column
+                # counts, the csv module pads/ignores, so parse it that way
+                logging.info("Arrow CSV parse failed at %s (%s); using csv module", p, e)
+        return _csv_to_rows_py(p)
     except Exception as e:
         logging.info("CSV parse failed at %s: %s", p, e)
         return None
 
 
+def _csv_to_rows_arrow(p: Path, pacsv: Any) -> List[Dict[str, Any]]:
+    import pyarrow as pa  # type: ignore
+    import pandas as pd  # type: ignore
+
+    # Memory-mapped bytes straight into Arrow's C++ parser (no Python-side decode);
+    # the map is closed right away so it can't pin the file (e.g. against the
+    # generator's os.replace on Windows)
+    with pa.memory_map(str(p), "r") as src:
+        table = pacsv.read_csv(
+            src,
+            convert_options=pacsv.ConvertOptions(
+                include_columns=["symbol"] + _NUMERIC_COLUMNS,
+                include_missing_columns=True,
+                column_types={"symbol": pa.string()},
+                # Only non-string columns parse nulls: an empty/"NA" symbol stays the
+                # raw string, as in _csv_to_rows_py (a missing column is still None)
+                strings_can_be_null=False,
+                null_values=["", "NA"],
+            ),
+        )
+    df = table.to_pandas()
+    for col in _NUMERIC_COLUMNS:
+        if not pd.api.types.is_numeric_dtype(df[col]):
+            # e.g. "$1,234.50" -> 1234.5; anything unparseable becomes NaN. _num
+            # (not pd.to_numeric) so values round-trip exactly as in _csv_to_rows_py
+            df[col] = df[col].map(_num, na_action="ignore").astype(object)
+        df[col] = df[col].astype("float64")
+    df = df.astype(object).where(df.notna(), None)
+    return df.to_dict(orient="records")
+
+
+def _csv_to_rows_py(p: Path) -> List[Dict[str, Any]]:
+    import csv
+
+    with p.open("r", encoding="utf-8", newline="") as f:
+        reader = csv.reader(f)
+        header = next(reader, None)
+        if header is None:
+            return []
+        index = {name: i for i, name in enumerate(header)}
+        width = len(header)
+        sym_i = index.get("symbol")
+        # Missing columns point at -1: the "" appended to every row below
+        pick = operator.itemgetter(*[index.get(c, -1) for c in _NUMERIC_COLUMNS])
+        out: List[Dict[str, Any]] = []
+        for row in reader:
+            if not row:
+                continue
+            if len(row) < width:
+                row.extend([""] * (width - len(row)))
+            row.append("")
+            rec: Dict[str, Any] = {"symbol": row[sym_i] if sym_i is not None else None}
+            rec.update(zip(_NUMERIC_COLUMNS, map(_num, pick(row))))
+            out.append(rec)
+    return out
+
+
+# "$" and thousands separators are stripped from numeric cells before float()
+_CLEAN_RE = re.compile(r"[$,]")
+
+
 def _num(v: Any) -> Optional[float]:
     if v is None or v == "":
         return None
+    s = _CLEAN_RE.sub("", v) if type(v) is str else v
     try:
-        return float(v)
-    except Exception:
-        try:
-            # strip $ or commas if present
-            s = str(v).replace("$", "").replace(",", "")
-            return float(s)
-        except Exception:
-            return None
+        return float(s)
+    except (TypeError, ValueError):
+        return None
+
+
+# Only what the generator needs; the host's other app settings/secrets stay out
+# of the child. Every POLYGON_* setting is forwarded (key, rate limit, workers,
+# cache dir/TTLs), plus what the interpreter and requests need for temp files,
+# proxies and CA bundles.
+_CHILD_ENV_KEYS = (
+    "PATH", "PYTHONPATH", "SYSTEMROOT", "HOME", "TMPDIR", "TEMP", "TMP",
+    "HTTP_PROXY", "HTTPS_PROXY", "NO_PROXY", "http_proxy", "https_proxy", "no_proxy",
+    "REQUESTS_CA_BUNDLE", "CURL_CA_BUNDLE", "SSL_CERT_FILE", "SSL_CERT_DIR",
+)
+_CHILD_ENV_PREFIX = "POLYGON_"
 
 
-def _run_generator_subprocess(generator: Path) -> Optional[List[Dict[str, Any]]]:
+def child_env(symbols: Optional[Sequence[str]]) -> Dict[str, str]:
+    """Environment for a generator subprocess (also used by the premiums function)."""
+    env = {k: v for k, v in os.environ.items() if k in _CHILD_ENV_KEYS or k.startswith(_CHILD_ENV_PREFIX)}
+    if symbols:
+        env["SYMBOLS"] = ",".join(symbols)
+    return env
+
+
+def _run_generator_subprocess(generator: Path, symbols: Optional[List[str]] = None) -> Optional[List[Dict[str, Any]]]:
     """
     Try to run the legacy generator so that it prints premiums JSON to stdout.
     We attempt two strategies:
       1) Call with --emit-json (if you added this flag).
       2) Call without flags, then try to read PUBLIC_JSON_PATHS.
     """
-    env = os.environ.copy()
+    import subprocess  # only needed on this legacy path
+
+    env = child_env(symbols)
     python = sys.executable or "python3"
 
     # Strategy 1: --emit-json to stdout
     try:
         cmd = [python, str(generator), "--emit-json"]
         logging.info("Running generator with --emit-json: %s", " ".join(cmd))
-        proc = subprocess.run(cmd, check=True, capture_output=True, text=True, env=env, timeout=120)
-        stdout = (proc.stdout or "").strip()
-        if stdout:
-            data = json.loads(stdout)
+        # Keep stdout as bytes: parsed directly, no decode/strip copies
+        proc = subprocess.run(cmd, check=True, capture_output=True, env=env, timeout=120)
+        stdout = proc.stdout
+        if stdout and not stdout.isspace():
+            data = _loads(stdout)
             if isinstance(data, list):
                 return data
             logging.warning("Generator stdout was not a list JSON")
     except subprocess.CalledProcessError as e:
-        logging.warning("Generator --emit-json failed (rc=%s): %s", e.returncode, e.stderr or e.stdout)
+        logging.warning("Generator --emit-json failed (rc=%s): %s", e.returncode,
+                        (e.stderr or e.stdout or b"").decode("utf-8", "replace"))
     except FileNotFoundError:
         logging.warning("Python executable not found while running generator")
     except Exception as e:
@@ -156,21 +289,63 @@ def _run_generator_subprocess(generator: Path) -> Optional[List[Dict[str, Any]]]
     return None
 
 
-# ---- Public API ------------------------------------------------------------
+def _load_generator_module(generator: Path) -> Any:
+    """Import the generator script once per worker and keep it hot."""
+    global _GENERATOR_MODULE
+    if _GENERATOR_MODULE is None:
+        name = generator.stem
+        spec = importlib.util.spec_from_file_location(name, generator)
+        if spec is None or spec.loader is None:
+            raise ImportError(f"Cannot load generator from {generator}")
+        mod = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(mod)
+        sys.modules[name] = mod
+        _GENERATOR_MODULE = mod
+    return _GENERATOR_MODULE
 
-def build_premiums() -> List[Dict[str, Any]]:
-    """
-    Returns a list of dicts that your UI consumes, with keys:
-      symbol, UnderlyingPrice, Shares, and for each delta in TARGET_DELTAS:
-      "<delta>S", "<delta>P", "<delta>N"
-    Resolution order:
-      1) If PREMIUMS_JSON_PATH env var points to a readable file, use it.
-      2) If a baked premiums.json exists at a known path, use it.
-      3) If PREMIUMS_CSV_PATH env var points to a readable CSV, parse it.
-      4) If a baked premiums.csv exists at a known path, parse it.
-      5) If the legacy generator script exists, try to run it and capture JSON.
-      6) Otherwise, return an empty list (UI will show 0 rows gracefully).
-    """
+
+def _run_generator_inprocess(generator: Path, symbols: Optional[List[str]]) -> Optional[List[Dict[str, Any]]]:
+    try:
+        mod = _load_generator_module(generator)
+        data = mod.generate(list(symbols) if symbols else None)
+        if isinstance(data, list):
+            return data
+        logging.warning("Generator generate() did not return a list; type=%s", type(data))
+    except Exception as e:
+        logging.warning("Generator in-process run errored: %s", e)
+    return None
+
+
+def _cache_get(symbols: Optional[Tuple[str, ...]]) -> Optional[List[Dict[str, Any]]]:
+    rows = _CACHE["rows"]
+    if rows is None or time.monotonic() - _CACHE["ts"] >= _CACHE_TTL:
+        return None
+    path = _CACHE["path"]
+    if path is None:
+        # Generator output depends on the symbols it was asked for
+        if _CACHE["symbols"] != symbols:
+            return None
+    else:
+        try:
+            if path.stat().st_mtime != _CACHE["mtime"]:
+                return None
+        except OSError:
+            return None
+    return rows
+
+
+def _cache_put(rows: List[Dict[str, Any]], path: Optional[Path], symbols: Optional[Tuple[str, ...]]) -> None:
+    mtime = None
+    if path is not None:
+        try:
+            mtime = path.stat().st_mtime
+        except OSError:
+            path = None
+    _CACHE.update(rows=rows, mtime=mtime, ts=time.monotonic(), path=path, symbols=symbols)
+
+
+def _load_premiums(symbols: Optional[List[str]]) -> Tuple[Optional[List[Dict[str, Any]]], Optional[Path]]:
+    """Run the resolution order from build_premiums(); returns (rows, source file)."""
     # 1) Explicit JSON path from env
     p = os.getenv("PREMIUMS_JSON_PATH")
     if p:
@@ -178,14 +353,16 @@ def build_premiums() -> List[Dict[str, Any]]:
         if path.is_file():
             data = _load_json_file(path)
             if data is not None:
-                return data
+                return data, path
+
+    resolved = _resolve_paths()
 
     # 2) Common baked JSON paths
-    json_path = _log_where(PUBLIC_JSON_PATHS)
+    json_path = resolved.json
     if json_path:
         data = _load_json_file(json_path)
         if data is not None:
-            return data
+            return data, json_path
 
     # 3) Explicit CSV path from env
     c = os.getenv("PREMIUMS_CSV_PATH")
@@ -194,21 +371,72 @@ def build_premiums() -> List[Dict[str, Any]]:
         if cpath.is_file():
             rows = _csv_to_rows(cpath)
             if rows is not None:
-                return rows
+                return rows, cpath
 
     # 4) Common baked CSV paths
-    csv_path = _log_where(CSV_PATHS)
+    csv_path = resolved.csv
     if csv_path:
         rows = _csv_to_rows(csv_path)
         if rows is not None:
-            return rows
+            return rows, csv_path
 
     # 5) Try running the legacy generator
-    generator = _log_where(DEFAULT_GENERATOR_PATHS)
+    generator = resolved.generator
     if generator:
-        rows = _run_generator_subprocess(generator)
+        if _GENERATOR_SUBPROCESS:
+            rows = _run_generator_subprocess(generator, symbols)
+        else:
+            rows = _run_generator_inprocess(generator, symbols)
+        if rows is not None:
+            return rows, None
+
+    return None, None
+
+
+# ---- Public API ------------------------------------------------------------
+
+def build_premiums(symbols: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+    """
+    Returns a list of dicts that your UI consumes, with keys:
+      symbol, UnderlyingPrice, Shares, and for each delta in TARGET_DELTAS:
+      "<delta>S", "<delta>P", "<delta>N"
+    Resolution order:
+      1) If PREMIUMS_JSON_PATH env var points to a readable file, use it.
+      2) If a baked premiums.json exists at a known path, use it.
+      3) If PREMIUMS_CSV_PATH env var points to a readable CSV, parse it.
+      4) If a baked premiums.csv exists at a known path, parse it.
+      5) If the legacy generator script exists, import it and call generate(symbols)
+         (or run it as a subprocess when PREMIUMS_GENERATOR_SUBPROCESS=1).
+      6) Otherwise, return an empty list (UI will show 0 rows gracefully).
+    Results are cached in-process for PREMIUMS_CACHE_TTL seconds (default 30)
+    and dropped early if the source file's mtime changes.
+    """
+    key = tuple(symbols) if symbols else None
+    with _CACHE_LOCK:
+        cached = _cache_get(key)
+        if cached is not None:
+            return cached
+
+        rows, source = _load_premiums(symbols)
         if rows is not None:
+            _cache_put(rows, source, key)
             return rows
 
     logging.warning("No premiums data available from JSON/CSV/generator; returning []")
     return []
+
+
+def invalidate_caches() -> None:
+    """Forget the resolved source paths and any cached rows (e.g. after new data is deployed)."""
+    _resolve_paths.cache_clear()
+    with _CACHE_LOCK:
+        _CACHE.update(rows=None, mtime=None, ts=0.0, path=None, symbols=None)
+
+
+def is_fresh(rows: Optional[List[Dict[str, Any]]]) -> bool:
+    """
+    True while `rows` is still what build_premiums() would return: it is the
+    cached list, inside the TTL, and its source file is unchanged. Lock-free,
+    so callers can check it on every request.
+    """
+    return rows is not None and _cache_get(_CACHE["symbols"]) is rows
@@ -0,0 +1,26 @@
+import logging
+import time
+
+import azure.functions as func
+
+from .. import premiums
+
+__all__ = ["main"]
+
+def main(req: func.HttpRequest) -> func.HttpResponse:
+    """
+    Keep-warm probe: /api/warmup
+    Imports the premiums function (and through it orjson + premiums_core) and
+    primes its caches for the default symbols, so the next /api/premiums call
+    on this worker is served from memory. Point any scheduler at it every few
+    minutes to stay inside the idle-unload window.
+    """
+    started = time.monotonic()
+    try:
+        count = premiums.prime()
+    except Exception as e:
+        logging.exception("Warmup failed")
+        return premiums._as_http({"error": "warmup_failed", "detail": str(e)}, 500)
+    elapsed_ms = round((time.monotonic() - started) * 1000, 1)
+    logging.info("Warmup primed %d rows in %.1f ms", count, elapsed_ms)
+    return premiums._as_http({"rows": count, "elapsed_ms": elapsed_ms}, 200)
@@ -57,7 +57,8 @@ export default function Page() {
 
   // Fetch data from Functions API (runtime)
   useEffect(() => {
-    fetch("/api/premiums", { cache: "no-store" })
+    // no-cache: the browser revalidates with If-None-Match and reuses its copy on 304
+    fetch("/api/premiums", { cache: "no-cache" })
       .then((r) => r.json())
       .then((data: PremiumRow[]) => setRows(Array.isArray(data) ? data : []))
       .catch(() => setRows([]));